@@ -0,0 +1,197 @@
+# Performance benchmarks, run: python benchmark.py <name>
+# Copyright (C) 2025 Kirill Osmolovsky
+import argparse, os, socket, tempfile, threading, time, shutil, sqlite3, hashlib, random, subprocess, sys
+from encryption import EncryptedWriter, EncryptedReader, CHUNK_SIZE
+from db import DatabaseManager
+
+def _transfer(path, key):
+    '''Send file over loopback TCP like the file server does, return seconds'''
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn, open(path, 'rb') as f:
+            if key:
+                writer = EncryptedWriter(conn.sendall, key)
+                shutil.copyfileobj(f, writer, CHUNK_SIZE)
+                writer.close()
+            else:
+                conn.sendfile(f)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    started = time.perf_counter()
+    with socket.create_connection(('127.0.0.1', port)) as client:
+        reader = client.makefile('rb')
+        source = EncryptedReader(reader, key) if key else reader
+        while source.read(CHUNK_SIZE):
+            pass
+    elapsed = time.perf_counter() - started
+    thread.join()
+    listener.close()
+    return elapsed
+
+def bench_encryption(size_mb=256, rounds=3):
+    '''Compare plaintext sendfile with pipelined AES-GCM over loopback'''
+    with tempfile.NamedTemporaryFile() as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024*1024))
+        f.flush()
+        key = os.urandom(32)
+        for name, k in (('plaintext (sendfile)', None), ('aes-256-gcm', key)):
+            best = min(_transfer(f.name, k) for _ in range(rounds))
+            print(f'{name:22} {size_mb / best:9.1f} MB/s')
+
+def _create_v0_databases(shared_db, local_db, count):
+    '''Databases as created before schema version 1, with hex TEXT hashes'''
+    rows = []
+    for i in range(count):
+        digest = hashlib.sha256(str(i).encode()).hexdigest()
+        rows.append((digest, f'file{i}.txt', f'/home/user/synced/dir{i % 100}/file{i}.txt', i % 10 == 0))
+    with sqlite3.connect(shared_db) as conn:
+        conn.execute('''
+            CREATE TABLE files (hash TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER,
+                                last_modified INTEGER, deleted BOOLEAN DEFAULT 0)
+        ''')
+        conn.execute('CREATE TABLE devices (ip TEXT PRIMARY KEY, last_seen INTEGER)')
+        conn.execute('CREATE INDEX idx_files_deleted ON files (deleted);')
+        conn.execute('CREATE INDEX idx_files_last_modified ON files (last_modified);')
+        conn.executemany('INSERT INTO files VALUES (?, ?, 1024, 1700000000, ?)',
+                         [(h, name, deleted) for h, name, _, deleted in rows])
+    with sqlite3.connect(local_db) as conn:
+        conn.execute('CREATE TABLE local_files (hash TEXT PRIMARY KEY, path TEXT NOT NULL, ignored BOOLEAN DEFAULT 0)')
+        conn.execute('CREATE TABLE directories (path TEXT PRIMARY KEY)')
+        conn.execute('CREATE INDEX idx_local_files_ignored ON local_files (ignored);')
+        conn.execute('CREATE INDEX idx_local_files_path ON local_files (path);')
+        conn.executemany('INSERT INTO local_files VALUES (?, ?, 0)', [(h, path) for h, _, path, _ in rows])
+    return [(h, path) for h, _, path, _ in rows]
+
+def _lookups(shared_db, local_db, samples, to_key):
+    timings = {}
+    with sqlite3.connect(shared_db) as conn:
+        started = time.perf_counter()
+        conn.execute('SELECT hash FROM files WHERE deleted = 0').fetchall()
+        timings['live hashes'] = time.perf_counter() - started
+    with sqlite3.connect(local_db) as conn:
+        started = time.perf_counter()
+        for digest, _ in samples:
+            conn.execute('SELECT path FROM local_files WHERE hash = ?', (to_key(digest),)).fetchone()
+        timings['hash -> path'] = time.perf_counter() - started
+        started = time.perf_counter()
+        for _, path in samples:
+            conn.execute('SELECT hash FROM local_files WHERE path = ?', (path,)).fetchone()
+        timings['path -> hash'] = time.perf_counter() - started
+    return timings
+
+def bench_schema(count=100000, lookups=20000):
+    '''Size and lookup speed of hex TEXT hashes against migrated BLOB hashes'''
+    with tempfile.TemporaryDirectory() as tmp:
+        shared_db, local_db = os.path.join(tmp, 'shared.db'), os.path.join(tmp, 'local.db')
+        rows = _create_v0_databases(shared_db, local_db, count)
+        samples = random.sample(rows, lookups)
+        results = {}
+        for version, to_key in (('v0 (hex TEXT)', str), ('v1 (BLOB)', bytes.fromhex)):
+            if results:
+                started = time.perf_counter()
+                DatabaseManager(shared_db, local_db)
+                print(f'migration of {count} files took {time.perf_counter() - started:.2f}s')
+            results[version] = {
+                'shared.db size': os.path.getsize(shared_db),
+                'local.db size': os.path.getsize(local_db),
+                **_lookups(shared_db, local_db, samples, to_key),
+            }
+        print(f'{"":16}' + ''.join(f'{name:>16}' for name in results))
+        for metric in next(iter(results.values())):
+            values = [r[metric] for r in results.values()]
+            if metric.endswith('size'):
+                print(f'{metric:16}' + ''.join(f'{v / 1024:>13.0f} KB' for v in values))
+            else:
+                print(f'{metric:16}' + ''.join(f'{v * 1000:>13.1f} ms' for v in values))
+
+def run_node(peers, files=0):
+    '''One device of the gossip benchmark, runs in its own directory on its own 127.0.0.x.
+        Files of the origin are created before monitoring starts, its startup scan
+        picks them up and notifies the fleet like after a restart
+    '''
+    import server
+    dbm = DatabaseManager()
+    dbm.set_transfer_key(b'\x01' * 32)
+    for ip in peers:
+        dbm.add_device(ip)
+    os.makedirs('synced', exist_ok=True)
+    dbm.add_directory(os.path.abspath('synced'))
+    for i in range(files):
+        with open(os.path.join('synced', f'file{i}.bin'), 'wb') as f:
+            f.write(os.urandom(1024*1024))
+    threading.Thread(target=server.Server().start_db_server, daemon=True).start()
+    threading.Thread(target=server.Server().start_file_server, daemon=True).start()
+    threading.Thread(target=server.DownloadDaemon().monitoring, daemon=True).start()
+    while True:
+        time.sleep(1)
+
+def _count_files(node_dir):
+    try:
+        with sqlite3.connect(os.path.join(node_dir, 'local.db')) as conn:
+            return conn.execute('SELECT COUNT(*) FROM local_files').fetchone()[0]
+    except sqlite3.Error:
+        return 0
+
+def bench_gossip(nodes=30, files=4, timeout=180):
+    '''Spread files from one device to a fleet of loopback nodes, count uploads per node'''
+    ips = [f'127.0.0.{i + 2}' for i in range(nodes)]
+    script = os.path.abspath(__file__)
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            # Origin (first ip) starts last, when everybody is listening
+            for i, ip in reversed(list(enumerate(ips))):
+                node_dir = os.path.join(tmp, ip)
+                os.makedirs(node_dir)
+                env = dict(os.environ, CATCHFILE_HOST=ip, CATCHFILE_LOG_LEVELS='server=DEBUG')
+                args = [sys.executable, script, 'node', '--peers', ','.join(ips)]
+                if i == 0:
+                    time.sleep(2)
+                    args += ['--files', str(files)]
+                processes.append(subprocess.Popen(args, cwd=node_dir, env=env,
+                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            started = time.monotonic()
+            while time.monotonic() - started < timeout:
+                done = sum(_count_files(os.path.join(tmp, ip)) >= files for ip in ips)
+                if done == nodes:
+                    break
+                time.sleep(0.5)
+            elapsed = time.monotonic() - started
+            time.sleep(1) # let log listeners flush
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+        uploads, notifications = {}, 0
+        for ip in ips:
+            with open(os.path.join(tmp, ip, 'catchfile.log'), errors='replace') as log:
+                lines = log.readlines()
+            uploads[ip] = sum('Sending file' in line for line in lines)
+            notifications += sum('Received DB_UPDATED' in line for line in lines)
+        print(f'{done}/{nodes} nodes synced {files} files in {elapsed:.1f}s')
+        print(f'origin uploads: {uploads[ips[0]]} (one peer at a time would be {(nodes - 1) * files})')
+        print(f'max uploads by one node: {max(uploads.values())}, total: {sum(uploads.values())}')
+        print(f'notifications received: {notifications} (one round is {nodes - 1})')
+
+BENCHMARKS = {
+    'encryption': bench_encryption,
+    'schema': bench_schema,
+    'gossip': bench_gossip,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CatchFile benchmarks')
+    parser.add_argument('name', choices=sorted(BENCHMARKS) + ['node'])
+    parser.add_argument('--peers', default='', help='node: comma separated ips of the fleet')
+    parser.add_argument('--files', type=int, default=0, help='node: create files and notify the fleet')
+    args = parser.parse_args()
+    if args.name == 'node':
+        run_node(args.peers.split(','), args.files)
+    else:
+        BENCHMARKS[args.name]()
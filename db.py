@@ -4,79 +4,223 @@ import sqlite3
 from pathlib import Path
 import hashlib
 import time
+import os
+import threading
 from log import Logger
 
-logger = Logger().get_logger()
+logger = Logger().get_logger('db')
+
+# Kept in PRAGMA user_version. 0: hex TEXT hashes, 1: 32-byte BLOB hashes,
+# 2: files.path with path relative to root_dir, so renames propagate
+SCHEMA_VERSION = 2
+BLOB_HASH_VERSION = 1
+
+FILES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        hash BLOB PRIMARY KEY,
+        filename TEXT NOT NULL,
+        size INTEGER,
+        last_modified INTEGER,
+        deleted BOOLEAN DEFAULT 0,
+        path TEXT
+    ) WITHOUT ROWID
+'''
+
+LOCAL_FILES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        hash BLOB PRIMARY KEY,
+        path TEXT NOT NULL,
+        ignored BOOLEAN DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+# A live record keeps its path: a copy elsewhere must not turn into a move
+# on other devices, only rename_file and rename_directory move files
+UPSERT_FILE = '''
+    INSERT INTO files (hash, filename, size, last_modified, deleted, path)
+    VALUES (?, ?, ?, ?, 0, ?)
+    ON CONFLICT(hash) DO UPDATE SET
+        size = excluded.size,
+        last_modified = excluded.last_modified,
+        filename = CASE WHEN deleted OR path IS NULL THEN excluded.filename ELSE filename END,
+        path = CASE WHEN deleted OR path IS NULL THEN excluded.path ELSE path END,
+        deleted = 0
+'''
+
+def _hex_to_blob(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
 
 class DatabaseManager:
+    # Bumped on every write to shared.db, tags cached snapshots
+    shared_generation = 0
+    _generation_lock = threading.Lock()
+
     def __init__(self, shared_db='shared.db', local_db='local.db'):
         self.shared_db = shared_db
         self.local_db = local_db
+        self.root_dir = 'synced' # same КОСТЫЛЬ as in Server
         self._init_shared_db()
         self._init_local_db()
-        logger.info('DatabaseManager initialized successfully')
+        logger.debug('DatabaseManager initialized successfully')
 
     def _init_shared_db(self):
         '''Create shared DB if not exists'''
         try:
             with sqlite3.connect(self.shared_db) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS files (
-                        hash TEXT PRIMARY KEY,
-                        filename TEXT NOT NULL,
-                        size INTEGER,
-                        last_modified INTEGER,
-                        deleted BOOLEAN DEFAULT 0
-                    )
-                ''')
-                cursor.execute('''
-                        CREATE TABLE IF NOT EXISTS devices (
-                            ip TEXT PRIMARY KEY, 
-                            last_seen INTEGER
-                        )
-                ''')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_deleted ON files (deleted);')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_last_modified ON files (last_modified);')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen);')
-
-                conn.commit()
-            logger.info('Shared database initialized')
+                self._prepare_shared_schema(conn)
+            logger.debug('Shared database initialized')
         except sqlite3.Error as e:
                 logger.error(f'Error initializing shared.db: {e}')
 
+    def _prepare_shared_schema(self, conn):
+        '''Create or migrate shared DB tables on an open connection'''
+        migrated = self._migrate_hash_table(conn, 'files', FILES_TABLE, 'filename, size, last_modified, deleted')
+        cursor = conn.cursor()
+        cursor.execute(FILES_TABLE.format(name='files'))
+        if 'path' not in {row[1] for row in cursor.execute('PRAGMA table_info(files)')}:
+            cursor.execute('ALTER TABLE files ADD COLUMN path TEXT')
+        cursor.execute('''
+                CREATE TABLE IF NOT EXISTS devices (
+                    ip TEXT PRIMARY KEY, 
+                    last_seen INTEGER
+                )
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_files_deleted;')
+        # Covers "live hashes" without touching table rows
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_live ON files (deleted, hash);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_last_modified ON files (last_modified);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen);')
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+        conn.commit()
+        if migrated:
+            conn.execute('VACUUM')
+
     def _init_local_db(self):
         '''Create local DB if not exists'''
         try:
             with sqlite3.connect(self.local_db) as conn:
+                migrated = self._migrate_hash_table(conn, 'local_files', LOCAL_FILES_TABLE, 'path, ignored')
                 cursor = conn.cursor()
+                cursor.execute(LOCAL_FILES_TABLE.format(name='local_files'))
                 cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS local_files (
-                        hash TEXT PRIMARY KEY,
-                        path TEXT NOT NULL,
-                        ignored BOOLEAN DEFAULT 0
+                    CREATE TABLE IF NOT EXISTS directories (
+                        path TEXT PRIMARY KEY
                     )
                 ''')
                 cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS directories (
-                        path TEXT PRIMARY KEY
+                    CREATE TABLE IF NOT EXISTS file_stats (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime_ns INTEGER,
+                        inode INTEGER
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS settings (
+                        name TEXT PRIMARY KEY,
+                        value BLOB
                     )
                 ''')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_local_files_ignored ON local_files (ignored);')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_local_files_path ON local_files (path);')
+                cursor.execute('DROP INDEX IF EXISTS idx_local_files_path;')
+                # Covers path -> hash, hash -> path is the primary key itself
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_local_files_path_hash ON local_files (path, hash);')
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
                 conn.commit()
-            logger.info('Local database initialized')
+                if migrated:
+                    conn.execute('VACUUM')
+            logger.debug('Local database initialized')
         except sqlite3.Error as e:
                 logger.error(f'Error initializing local.db: {e}')
 
+    def _migrate_hash_table(self, conn, table, create_sql, columns):
+        '''Rebuild a schema 0 table with hex TEXT hashes as BLOB hashes, in place.
+            Returns True if table was migrated
+        '''
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        if version >= BLOB_HASH_VERSION or not exists:
+            return False
+        conn.create_function('hex_to_blob', 1, _hex_to_blob, deterministic=True)
+        conn.execute('BEGIN')
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}_v0')
+        conn.execute(create_sql.format(name=table))
+        # Rows with malformed hashes get NULL key and are skipped
+        conn.execute(f'''
+            INSERT OR IGNORE INTO {table} (hash, {columns})
+            SELECT hex_to_blob(hash), {columns} FROM {table}_v0
+        ''')
+        conn.execute(f'DROP TABLE {table}_v0')
+        logger.info(f'Migrated {table} to BLOB hashes')
+        return True
+
+    def _bump_shared_generation(self):
+        with DatabaseManager._generation_lock:
+            DatabaseManager.shared_generation += 1
+
+    def snapshot_shared_db(self, dest_path: str):
+        '''Copy shared.db into dest_path with the SQLite online backup API.
+            Returns generation the snapshot is at least as new as
+        '''
+        generation = DatabaseManager.shared_generation
+        src = sqlite3.connect(self.shared_db)
+        dst = sqlite3.connect(dest_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        return generation
+
+    def replace_shared_db(self, candidate_path: str):
+        '''Validate downloaded database and atomically swap it in as shared.db'''
+        try:
+            conn = sqlite3.connect(candidate_path)
+            try:
+                check = conn.execute('PRAGMA quick_check').fetchone()
+                tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error(f'Downloaded shared database is not readable: {e}')
+            return False
+        if not check or check[0] != 'ok' or not {'files', 'devices'} <= tables:
+            logger.error(f'Downloaded shared database failed validation: {check}, tables {sorted(tables)}')
+            return False
+        try:
+            # Peer may still run an older schema
+            with sqlite3.connect(candidate_path) as conn:
+                self._prepare_shared_schema(conn)
+            conn.close()
+        except sqlite3.Error as e:
+            logger.error(f'Failed to migrate downloaded shared database: {e}')
+            return False
+        os.replace(candidate_path, self.shared_db)
+        self._bump_shared_generation()
+        logger.info('Shared database replaced with downloaded copy')
+        return True
+
     def _calculate_file_hash(self, file_path, chunk_size=65536):
         # SHA-256
         hasher = hashlib.sha256()
         with open(file_path, 'rb') as f:
             for chunk in iter(lambda: f.read(chunk_size), b''):
                 hasher.update(chunk)
-        return hasher.hexdigest()   
+        return hasher.digest()
+
+    def _shared_path(self, file_path):
+        '''Path relative to root_dir as stored in shared.db, None for files outside of it'''
+        try:
+            return Path(file_path).relative_to(Path(self.root_dir).resolve()).as_posix()
+        except ValueError:
+            return None
 
     def add_directory(self, dir_path: str):
         '''Add directory path into directories table in local.db'''
@@ -92,24 +236,24 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logger.error(f'Database error while adding directory {dir_path}: {e}')
 
-    def add_file(self, file_path: str):
-        '''Add file to both DB'''
+    def add_file(self, file_path: str, file_hash=None):
+        '''Add file to both DB, file_hash skips rehashing when already verified'''
         file_path = Path(file_path).resolve()
         if not file_path.exists() or not file_path.is_file():
             logger.error(f'File {file_path} does not exists')
             raise ValueError('File does not exists')
-        file_size = file_path.stat().st_size
-        last_modified = int(file_path.stat().st_mtime)
-        file_hash =  self._calculate_file_hash(file_path)
+        stat = file_path.stat()
+        file_size = stat.st_size
+        last_modified = int(stat.st_mtime)
+        if file_hash is None:
+            file_hash =  self._calculate_file_hash(file_path)
         try:
             with sqlite3.connect(self.shared_db) as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO files (hash, filename, size, last_modified, deleted)
-                    VALUES (?, ?, ?, ?, 0)
-                ''', (file_hash, file_path.name, file_size, last_modified))
+                cursor.execute(UPSERT_FILE, (file_hash, file_path.name, file_size, last_modified, self._shared_path(file_path)))
                 conn.commit()
-            logger.info(f'File {file_path.name} added to shared database')
+                self._bump_shared_generation()
+            logger.debug('File %s added to shared database', file_path.name)
         except sqlite3.Error as e:
             logger.error(f'Database error while placing files in shared database: {e}')
         try:
@@ -119,8 +263,9 @@ class DatabaseManager:
                     INSERT OR REPLACE INTO local_files (hash, path, ignored)
                     VALUES (?, ?, 0)
                 ''', (file_hash, str(file_path)))
+                self._store_file_stat(cursor, str(file_path), stat)
                 conn.commit()
-            logger.info(f'File {file_path.name} added to local database')
+            logger.debug('File %s added to local database', file_path.name)
         except sqlite3.Error as e:
             logger.error(f'Database error while placing files in local database: {e}')
     
@@ -135,7 +280,7 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logger.error(f'Database error while retrieving local directories: {e}')
 
-    def get_file_path_by_hash(self, file_hash: str):
+    def get_file_path_by_hash(self, file_hash: bytes):
         '''Get file path by hash from local database'''
         try:
             with sqlite3.connect(self.local_db) as conn:
@@ -146,12 +291,46 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logger.error(f'Database error while retrieving file path by hash: {e}')
 
+    def get_file_paths_by_hashes(self, hashes):
+        '''Map hashes to local paths in one query per 500 hashes'''
+        paths = {}
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                for i in range(0, len(hashes), 500):
+                    part = hashes[i:i + 500]
+                    cursor.execute(f'''
+                        SELECT hash, path FROM local_files WHERE hash IN ({','.join('?' * len(part))})
+                    ''', part)
+                    paths.update(cursor.fetchall())
+        except sqlite3.Error as e:
+            logger.error(f'Database error while retrieving file paths by hashes: {e}')
+        return paths
+
+    def get_file_sizes(self, hashes):
+        '''Map hashes to file sizes from shared database'''
+        sizes = {}
+        try:
+            with sqlite3.connect(self.shared_db) as conn:
+                cursor = conn.cursor()
+                for i in range(0, len(hashes), 500):
+                    part = hashes[i:i + 500]
+                    cursor.execute(f'''
+                        SELECT hash, size FROM files WHERE size IS NOT NULL AND hash IN ({','.join('?' * len(part))})
+                    ''', part)
+                    sizes.update(cursor.fetchall())
+        except sqlite3.Error as e:
+            logger.error(f'Database error while retrieving file sizes: {e}')
+        return sizes
+
     def update_file_hash(self, file_path: str):
         '''Mark old hash as deleted in shared.db and insert new entry, update local hash'''
         file_path = Path(file_path).resolve()
         new_file_hash = self._calculate_file_hash(file_path)
-        last_modified = int(file_path.stat().st_mtime)
-        file_size = file_path.stat().st_size
+        stat = file_path.stat()
+        last_modified = int(stat.st_mtime)
+        file_size = stat.st_size
+        old_file_hash = self.get_file_hash_by_path(str(file_path))
 
         try:
             with sqlite3.connect(self.local_db) as conn:
@@ -161,27 +340,90 @@ class DatabaseManager:
                     SET hash = ? 
                     WHERE path = ?
                 ''', (new_file_hash, str(file_path)))
+                self._store_file_stat(cursor, str(file_path), stat)
                 conn.commit()
         
             with sqlite3.connect(self.shared_db) as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    UPDATE files 
-                    SET deleted = 1 
-                    WHERE filename = ?
-                ''', (file_path.name,))
+                if old_file_hash and old_file_hash != new_file_hash:
+                    cursor.execute('''
+                        UPDATE files 
+                        SET deleted = 1 
+                        WHERE hash = ?
+                    ''', (old_file_hash,))
             
-                cursor.execute('''
-                    INSERT INTO files (hash, filename, size, last_modified, deleted) 
-                    VALUES (?, ?, ?, ?, 0)
-                ''', (new_file_hash, file_path.name, file_size, last_modified))
+                cursor.execute(UPSERT_FILE, (new_file_hash, file_path.name, file_size, last_modified, self._shared_path(file_path)))
                 conn.commit()
+                self._bump_shared_generation()
 
-            logger.info(f'Updated hash for {file_path} in local database and added new entry to shared database')
+            logger.debug('Updated hash for %s in local database and added new entry to shared database', file_path)
 
         except sqlite3.Error as e:
             logger.error(f'Database error while updating file hash: {e}')
 
+    def rename_file(self, old_path: str, new_path: str, file_hash: bytes):
+        '''Move file record to new path in both DB, content is unchanged so nothing is rehashed'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('UPDATE local_files SET path = ? WHERE hash = ?', (new_path, file_hash))
+                cursor.execute('DELETE FROM file_stats WHERE path = ?', (new_path,))
+                cursor.execute('UPDATE file_stats SET path = ? WHERE path = ?', (new_path, old_path))
+                conn.commit()
+            with sqlite3.connect(self.shared_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE files SET filename = ?, path = ? WHERE hash = ?
+                ''', (Path(new_path).name, self._shared_path(new_path), file_hash))
+                conn.commit()
+                self._bump_shared_generation()
+            logger.debug('File %s renamed to %s', old_path, new_path)
+        except sqlite3.Error as e:
+            logger.error(f'Database error while renaming file {old_path}: {e}')
+
+    def rename_directory(self, old_dir: str, new_dir: str):
+        '''Move records of all files under old_dir to new_dir, returns number of files'''
+        # Range instead of LIKE: uses the path index and needs no escaping
+        low, high = old_dir + os.sep, old_dir + chr(ord(os.sep) + 1)
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT hash, path FROM local_files WHERE path >= ? AND path < ?', (low, high))
+                moved = [(file_hash, new_dir + path[len(old_dir):]) for file_hash, path in cursor.fetchall()]
+                cursor.executemany('UPDATE local_files SET path = ? WHERE hash = ?',
+                                   [(path, file_hash) for file_hash, path in moved])
+                cursor.execute('''
+                    UPDATE file_stats SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?
+                ''', (new_dir, len(old_dir) + 1, low, high))
+                conn.commit()
+            with sqlite3.connect(self.shared_db) as conn:
+                cursor = conn.cursor()
+                cursor.executemany('UPDATE files SET filename = ?, path = ? WHERE hash = ?',
+                                   [(Path(path).name, self._shared_path(path), file_hash) for file_hash, path in moved])
+                conn.commit()
+                self._bump_shared_generation()
+            logger.info(f'Directory {old_dir} renamed to {new_dir}, {len(moved)} files moved')
+            return len(moved)
+        except sqlite3.Error as e:
+            logger.error(f'Database error while renaming directory {old_dir}: {e}')
+            return 0
+
+    def get_shared_paths(self):
+        '''(hash, path in shared.db, local path) of every live file present locally'''
+        try:
+            with sqlite3.connect(self.shared_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('ATTACH DATABASE ? AS local', (self.local_db,))
+                cursor.execute('''
+                    SELECT f.hash, f.path, l.path
+                    FROM files f JOIN local.local_files l ON l.hash = f.hash
+                    WHERE f.deleted = 0 AND f.path IS NOT NULL AND l.ignored = 0
+                ''')
+                return cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f'Database error while getting shared paths: {e}')
+            return []
+
     def get_file_hash_by_path(self, file_path: str):
         '''Get file hash by path from local database'''
         try:
@@ -200,23 +442,28 @@ class DatabaseManager:
         try:
             with sqlite3.connect(self.shared_db) as conn:
                 cursor = conn.cursor()
+                known = cursor.execute('SELECT 1 FROM devices WHERE ip = ?', (ip,)).fetchone()
                 cursor.execute('''
                     INSERT INTO devices (ip, last_seen)
                     VALUES (?, ?) ON CONFLICT(ip) DO UPDATE SET last_seen=?
                 ''', (ip, int(time.time()), int(time.time())))
                 conn.commit()
-                logger.info(f'Device {ip} added/updated in shared database')
+                if not known:
+                    # last_seen refresh alone should not invalidate cached snapshots
+                    self._bump_shared_generation()
+                logger.debug('Device %s added/updated in shared database', ip)
         except sqlite3.Error as e:
             logger.error(f'Database error while adding new device ip: {e}')
 
-    def remove_file(self, file_hash: str):
+    def remove_file(self, file_hash: bytes):
         '''Mark file in DB as deleted'''
         try:
             with sqlite3.connect(self.shared_db) as conn:
                 cursor = conn.cursor()
                 cursor.execute('UPDATE files SET deleted = 1 WHERE hash = ?', (file_hash,))
                 conn.commit()
-                logger.info(f'File with hash {file_hash} marked as deleted in shared database')
+                self._bump_shared_generation()
+                logger.debug('File with hash %s marked as deleted in shared database', file_hash and file_hash.hex())
         except sqlite3.Error as e:
             logger.error(f'Database error while marking file as deleted: {e}')
 
@@ -231,14 +478,17 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logger.error(f'Database error while deleting directory from directries: {e}')
 
-    def remove_file_by_hash(self, file_hash: str):
+    def remove_file_by_hash(self, file_hash: bytes):
         '''Remove file from local DB by hash'''
         try:
             with sqlite3.connect(self.local_db) as conn:
                 cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM file_stats WHERE path IN (SELECT path FROM local_files WHERE hash = ?)
+                ''', (file_hash,))
                 cursor.execute('DELETE FROM local_files WHERE hash = ?', (file_hash,))
                 conn.commit()
-            logger.info(f'File with hash {file_hash} removed from local database')
+            logger.debug('File with hash %s removed from local database', file_hash and file_hash.hex())
         except sqlite3.Error as e:
             logger.error(f'Database error while deleting gfile from local.db: {e}')
 
@@ -253,10 +503,10 @@ class DatabaseManager:
             with sqlite3.connect(self.local_db) as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    UPDATE local_files SET ignored = 1 WHERE hash LIKE ?
+                    UPDATE local_files SET ignored = 1 WHERE hash = ?
                 ''', (file_hash,))
                 conn.commit()
-                logger.info(f'File {file_path} set to ignored in local database')
+                logger.debug('File %s set to ignored in local database', file_path)
         except sqlite3.Error as e:
             logger.error(f'Database error while marking file as ignored: {e}')
 
@@ -298,6 +548,100 @@ class DatabaseManager:
         except sqlite3.Error as e:
             logger.error(f'Database error while getting all local files: {e}')
 
+    def get_file_index(self):
+        '''Map every indexed local path to (hash, size, mtime_ns, inode, ignored).
+            Stat columns are None for files indexed before stats were recorded
+        '''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT lf.path, lf.hash, fs.size, fs.mtime_ns, fs.inode, lf.ignored
+                    FROM local_files lf LEFT JOIN file_stats fs ON fs.path = lf.path
+                ''')
+                return {row[0]: row[1:] for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f'Database error while getting file index: {e}')
+            return {}
+
+    def get_untracked_stats(self):
+        '''Map paths with a stat fingerprint but no local_files row to (size, mtime_ns, inode).
+            These are extra copies of content already indexed under another path
+        '''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT fs.path, fs.size, fs.mtime_ns, fs.inode
+                    FROM file_stats fs LEFT JOIN local_files lf ON lf.path = fs.path
+                    WHERE lf.path IS NULL
+                ''')
+                return {row[0]: row[1:] for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f'Database error while getting untracked stats: {e}')
+            return {}
+
+    def get_file_stat(self, file_path: str):
+        '''Stored (size, mtime_ns, inode) of a file'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT size, mtime_ns, inode FROM file_stats WHERE path = ?', (file_path,))
+                return cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error(f'Database error while retrieving file stat: {e}')
+
+    def update_file_stat(self, file_path: str, stat):
+        '''Remember stat fingerprint of a file without rehashing it'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                self._store_file_stat(cursor, file_path, stat)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f'Database error while updating file stat: {e}')
+
+    def remove_file_stat(self, file_path: str):
+        '''Forget stat fingerprint of a path, e.g. a deleted copy that was never indexed'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM file_stats WHERE path = ?', (file_path,))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f'Database error while removing file stat: {e}')
+
+    def _store_file_stat(self, cursor, file_path, stat):
+        cursor.execute('''
+            INSERT OR REPLACE INTO file_stats (path, size, mtime_ns, inode)
+            VALUES (?, ?, ?, ?)
+        ''', (file_path, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+
+    def set_transfer_key(self, key: bytes):
+        '''Store key, shared through magnet link, used to encrypt transfers'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO settings (name, value)
+                    VALUES ('transfer_key', ?)
+                ''', (key,))
+                conn.commit()
+            logger.info('Transfer encryption key stored in local database')
+        except sqlite3.Error as e:
+            logger.error(f'Database error while storing transfer key: {e}')
+
+    def get_transfer_key(self):
+        '''Get transfer encryption key, None if device isn't paired yet'''
+        try:
+            with sqlite3.connect(self.local_db) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT value FROM settings WHERE name = 'transfer_key'")
+                result = cursor.fetchone()
+                return result[0] if result else None
+        except sqlite3.Error as e:
+            logger.error(f'Database error while retrieving transfer key: {e}')
+
     def get_known_ips(self):
         '''Retrieve a list of known IP addresses from the devices table.'''
         try:
@@ -315,6 +659,7 @@ class DatabaseManager:
                 cursor = conn.cursor()
                 cursor.execute('DELETE FROM files WHERE deleted = 1')
                 conn.commit()
+                self._bump_shared_generation()
             logger.info('Deleted files cleaned up from shared database')
         except sqlite3.Error as e:
             logger.error(f'Database error while cleaning up deleted files: {e}')
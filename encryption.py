@@ -0,0 +1,173 @@
+# Chunked AES-256-GCM streams for file and database transfers
+# Copyright (C) 2025 Kirill Osmolovsky
+import os, struct, threading, queue
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+
+MAGIC = b'CFE1'
+CHUNK_SIZE = 256*1024 # 21 bytes of framing and tag per chunk
+# magic, random nonce prefix of the stream
+STREAM_HEADER = struct.Struct('>4s8s')
+# ciphertext length, last chunk flag
+CHUNK_HEADER = struct.Struct('>IB')
+
+def _nonce(prefix, counter):
+    return prefix + counter.to_bytes(4, 'big')
+
+def _aad(counter, last):
+    # Binds chunk position and end of stream, so chunks can't be reordered or cut off
+    return struct.pack('>IB', counter, last)
+
+
+class EncryptedWriter:
+    '''File-like object, encrypts written data and passes it to send().
+        Encryption and sending run in a worker thread, so the caller can keep
+        reading from disk while the previous chunk is on the wire.
+    '''
+    def __init__(self, send, key, chunk_size=CHUNK_SIZE, depth=4):
+        self.send = send
+        self.aesgcm = AESGCM(key)
+        self.chunk_size = chunk_size
+        self.prefix = os.urandom(8)
+        self.buffer = bytearray()
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.closed = False
+        self.send(STREAM_HEADER.pack(MAGIC, self.prefix))
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        counter = 0
+        while True:
+            data, last = self.queue.get()
+            if self.error is None:
+                try:
+                    ciphertext = self.aesgcm.encrypt(_nonce(self.prefix, counter), data, _aad(counter, last))
+                    self.send(CHUNK_HEADER.pack(len(ciphertext), last))
+                    self.send(ciphertext)
+                except Exception as e:
+                    # Keep draining the queue so write() never blocks forever
+                    self.error = e
+            counter += 1
+            # abort() queues a last item too, so the worker always ends
+            if last:
+                return
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        if not self.buffer and len(data) == self.chunk_size:
+            self.queue.put((bytes(data), False))
+            return len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.queue.put((bytes(self.buffer[:self.chunk_size]), False))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        '''Send last chunk and wait until everything is on the wire'''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((bytes(self.buffer), True))
+        self.buffer = bytearray()
+        self.worker.join()
+        if self.error:
+            raise self.error
+
+    def abort(self):
+        '''Stop the worker without sending the last chunk, peer sees a truncated stream.
+            Does nothing after close(), so it fits in a finally block
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        if self.error is None:
+            self.error = ConnectionAbortedError('Encrypted stream aborted')
+        self.queue.put((b'', True))
+        self.worker.join()
+
+
+class EncryptedReader:
+    '''File-like object, receives chunks from reader and decrypts them.
+        Receiving and decryption run in a worker thread, so the caller can
+        write the previous chunk to disk meanwhile. header is the start of the
+        stream if the caller already read it to tell the reply type.
+    '''
+    def __init__(self, reader, key, depth=4, header=b''):
+        header += reader.read(STREAM_HEADER.size - len(header))
+        if len(header) < STREAM_HEADER.size or header[:4] != MAGIC:
+            raise ValueError('Peer sent an unencrypted or unknown stream')
+        self.prefix = STREAM_HEADER.unpack(header)[1]
+        self.reader = reader
+        self.aesgcm = AESGCM(key)
+        self.queue = queue.Queue(depth)
+        self.current = b''
+        self.offset = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        counter = 0
+        try:
+            while True:
+                header = self.reader.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    raise ConnectionError('Encrypted stream is truncated')
+                length, last = CHUNK_HEADER.unpack(header)
+                ciphertext = self.reader.read(length)
+                if len(ciphertext) < length:
+                    raise ConnectionError('Encrypted stream is truncated')
+                try:
+                    data = self.aesgcm.decrypt(_nonce(self.prefix, counter), ciphertext, _aad(counter, last))
+                except InvalidTag:
+                    raise ValueError('Encrypted chunk failed authentication')
+                counter += 1
+                if not self._put(data):
+                    return
+                if last:
+                    self._put(None)
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.current):
+                if self.error:
+                    raise self.error
+                if self.eof:
+                    break
+                item = self.queue.get()
+                if isinstance(item, Exception):
+                    self.error = item
+                    raise item
+                if item is None:
+                    self.eof = True
+                    break
+                self.current, self.offset = item, 0
+                continue
+            end = len(self.current) if size < 0 else min(len(self.current), self.offset + size)
+            parts.append(self.current[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+    def close(self):
+        self.closed = True
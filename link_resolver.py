@@ -5,7 +5,7 @@ from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import server
 from log import Logger
 
-logger = Logger().get_logger()
+logger = Logger().get_logger('link')
 
 class MagnetLinkGenerator:
     def __init__(self, shared_db='shared.db'):
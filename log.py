@@ -1,6 +1,91 @@
 # Copyright (C) 2025 Kirill Osmolovsky
-import logging
-from logging.handlers import RotatingFileHandler
+import logging, os, queue, threading, time, atexit
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# Per-subsystem levels, e.g. CATCHFILE_LOG_LEVELS="db=WARNING,server=DEBUG"
+LEVELS_ENV = 'CATCHFILE_LOG_LEVELS'
+
+class _DeferredQueueHandler(QueueHandler):
+    '''Queue records as they are, formatting happens in the listener thread'''
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    '''Let through at most `rate` INFO/DEBUG records per second from one call site.
+        Warnings and errors are never dropped
+    '''
+    def __init__(self, rate=20):
+        super().__init__()
+        self.rate = rate
+        self.sites = {} # call site -> [window start, count, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.setdefault((record.name, record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= 1.0:
+                site[0], site[1] = now, 0
+            if site[1] >= self.rate:
+                site[2] += 1
+                return False
+            site[1] += 1
+            record.suppressed, site[2] = site[2], 0
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    '''[time] LEVEL subsystem: message (funcName) key=value ...'''
+    def __init__(self):
+        super().__init__('[%(asctime)s] %(levelname)s %(subsystem)s: %(message)s (%(funcName)s)')
+
+    def format(self, record):
+        record.subsystem = record.name.rpartition('.')[2]
+        line = super().format(record)
+        fields = dict(getattr(record, 'fields', None) or {})
+        if getattr(record, 'suppressed', 0):
+            fields['suppressed'] = record.suppressed
+        if fields:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        return line
+
+
+class Progress:
+    '''Count per-item outcomes and log one summary line per interval
+        instead of a line per file. Items themselves go to DEBUG
+    '''
+    def __init__(self, logger, task, interval=5.0):
+        self.logger = logger
+        self.task = task
+        self.interval = interval
+        self.counts = {}
+        self.started = self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, outcome='done', item=None):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            now = time.monotonic()
+            due = now - self.last >= self.interval
+            if due:
+                self.last = now
+        if item is not None and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('%s %s: %s', self.task, outcome, item.hex() if isinstance(item, bytes) else item)
+        if due:
+            self._emit('in progress')
+
+    def close(self):
+        self._emit('finished')
+
+    def _emit(self, state):
+        with self.lock:
+            fields = dict(self.counts)
+        fields['elapsed'] = f'{time.monotonic() - self.started:.1f}s'
+        self.logger.info('%s %s', self.task, state, extra={'fields': fields}, stacklevel=3)
+
 
 class Logger:
     _instance = None
@@ -12,15 +97,38 @@ class Logger:
         return cls._instance
 
     def _initialize(self):
-        self.logger = logging.getLogger(__name__)
+        self.logger = logging.getLogger('catchfile')
         self.logger.setLevel(logging.INFO)
-        
+        self.levels = self._parse_levels(os.environ.get(LEVELS_ENV, ''))
+
         if not self.logger.handlers:
             log_handler = RotatingFileHandler('catchfile.log', maxBytes=1024*1024, backupCount=3)
-            log_formatter = logging.Formatter('[%(asctime)s] %(message)s (%(funcName)s)')
-            log_handler.setFormatter(log_formatter)
-            log_handler.setLevel(logging.INFO)
-            self.logger.addHandler(log_handler)
+            log_handler.setFormatter(StructuredFormatter())
+            log_handler.setLevel(logging.DEBUG)
+
+            # Callers only enqueue, formatting and file I/O happen in listener thread
+            log_queue = queue.SimpleQueue()
+            queue_handler = _DeferredQueueHandler(log_queue)
+            queue_handler.addFilter(RateLimitFilter())
+            self.logger.addHandler(queue_handler)
+            self.listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.listener.stop)
+
+    def _parse_levels(self, spec):
+        levels = {}
+        for item in spec.split(','):
+            name, _, level = item.partition('=')
+            level = level.strip().upper()
+            if name.strip() and isinstance(logging.getLevelName(level), int):
+                levels[name.strip()] = level
+        return levels
 
-    def get_logger(self):
-        return self.logger
\ No newline at end of file
+    def get_logger(self, subsystem=None):
+        '''Logger of a subsystem (db, server, scanner, ...), level from CATCHFILE_LOG_LEVELS'''
+        if subsystem is None:
+            return self.logger
+        logger = self.logger.getChild(subsystem)
+        if subsystem in self.levels:
+            logger.setLevel(self.levels[subsystem])
+        return logger
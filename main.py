@@ -5,7 +5,7 @@ import db #DataBase logic
 import link_resolver # for magnet links
 import server, log
 
-logger = log.Logger().get_logger()
+logger = log.Logger().get_logger('main')
 
 def addDirectory():
     path = Path(input('Enter a directory path on your local device: ').strip()).resolve()
@@ -14,16 +14,23 @@ def addDirectory():
         return
     
     dbm = db.DatabaseManager()
+    progress = log.Progress(logger, f'Adding {path}')
     for file in path.rglob('*'):
         if file.is_file():
             dbm.add_file(str(file))
-            logger.info(f'File {file} added to db')
+            progress.add('added', file)
+    progress.close()
     dbm.add_directory(str(path))
     server.DownloadDaemon().notify_devices()
 
 
 def addDevice():
-    key = os.urandom(32) 
+    dbm = db.DatabaseManager()
+    # All devices share one key, otherwise they couldn't decrypt each other's transfers
+    key = dbm.get_transfer_key()
+    if not key:
+        key = os.urandom(32) 
+        dbm.set_transfer_key(key)
     generator = link_resolver.MagnetLinkGenerator()
     magnet_link = generator.generate_magnet_link(key)
 
@@ -46,14 +53,18 @@ def connect2device():
         return
 
     s = server.Server()
+    s.dbm.set_transfer_key(key)
 
-    logger.info(f'Connected to device! Encryption key (store securely!): {key}')
+    logger.info('Connected to device! Encryption key stored in local database')
     try:
         s.download_shared_db(ip)
+        progress = log.Progress(logger, 'Indexing local directories')
         for p in s.dbm.get_local_directories():
             p = Path(p)
             for file in p.rglob('*'):
                 s.dbm.add_file(str(file))
+                progress.add('added', file)
+        progress.close()
         server.DownloadDaemon().notify_devices()
     except socket.timeout:
         logger.info(f"Connection to {ip} timed out!")
@@ -71,16 +82,21 @@ def removeDirectory():
     path = Path(input('Enter a directory path on your local device to remove it from sync: ').strip()).resolve()
     dbm = db.DatabaseManager()
     dbm.remove_directory(str(path))
+    progress = log.Progress(logger, f'Unsyncing {path}')
     for file in path.rglob('*'):
         if file.is_file():
             dbm.unsync_file(str(file))
-            logger.info(f'File {file} uncynsed now')
+            progress.add('unsynced', file)
+    progress.close()
 
 def removeFiles():
     '''DELETE FILE EVERYWHERE'''
     path = Path(input('Enter a file path on your local device to delete it on synced devices: ').strip()).resolve()
     dbm = db.DatabaseManager()
     file_hash = dbm.get_file_hash_by_path(str(path))
+    if not file_hash:
+        logger.error(f'{path} is not synced')
+        return
     dbm.remove_file(file_hash)
     dbm.remove_file_by_hash(file_hash)
     os.remove(str(path))
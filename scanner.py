@@ -0,0 +1,180 @@
+# Startup reconciliation of synced directories with local.db
+# Copyright (C) 2025 Kirill Osmolovsky
+import os, time, contextlib
+from log import Logger
+
+logger = Logger().get_logger('scanner')
+
+class StartupScanner:
+    '''Find files added, edited or deleted while the daemon was stopped.
+
+        Walks synced directories with os.scandir and compares stat fingerprints
+        (size, mtime_ns, inode) against local.db. Only new, changed or missing
+        files go through add_file, update_file_hash and remove_file, unchanged
+        files cost a single lstat and are never reopened. A new file with the
+        inode, size and mtime of a missing one is recorded as a rename. Extra
+        copies of indexed content only get their stat recorded, local.db keeps
+        one path per hash.
+    '''
+    def __init__(self, dbm, lock=None, time_budget=60.0):
+        self.dbm = dbm
+        self.lock = lock if lock is not None else contextlib.nullcontext()
+        self.time_budget = time_budget
+
+    def scan(self, directories):
+        '''Reconcile directories with the index, return report dict'''
+        started = time.monotonic()
+        deadline = started + self.time_budget
+        report = {'new': 0, 'changed': 0, 'missing': 0, 'renamed': 0, 'unchanged': 0,
+                  'adopted': 0, 'copies': 0, 'errors': 0, 'complete': True, 'elapsed': 0.0}
+
+        with self.lock:
+            index = self.dbm.get_file_index()
+            copies = self.dbm.get_untracked_stats()
+
+        for directory in directories or []:
+            root = os.path.realpath(directory)
+            if not os.path.isdir(root):
+                # Unmounted drive or renamed root: never tombstone a whole tree
+                logger.warning(f'Synced directory {root} is not available, skipping')
+                continue
+            seen, new, copied = set(), [], []
+            complete = self._walk(root, index, copies, seen, new, copied, report, deadline)
+            if complete:
+                missing = self._find_missing(root, index, seen)
+                new = self._match_renames(new, missing, index, report)
+                if missing:
+                    # A copy may be the only one left of a missing file's content
+                    new += copied
+                else:
+                    report['copies'] += len(copied)
+                # Unhashed new files may hold content of missing ones, keep those then
+                complete = self._add_new(new, index, missing, report, deadline)
+            if not complete:
+                report['complete'] = False
+                logger.warning(f'Startup scan of {root} exceeded {self.time_budget}s budget, '
+                               'the watcher or the next scan picks up the rest')
+                break
+            self._remove_missing(missing, index, report)
+
+        report['elapsed'] = time.monotonic() - started
+        logger.info('Startup scan finished', extra={'fields': dict(report, elapsed=f"{report['elapsed']:.2f}s")})
+        return report
+
+    def _walk(self, root, index, copies, seen, new, copied, report, deadline):
+        '''Iterative scandir walk, returns False when time budget runs out'''
+        stack = [root]
+        while stack:
+            if time.monotonic() > deadline:
+                return False
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            seen.add(entry.path)
+                            self._check_file(entry, index.get(entry.path), copies.get(entry.path), new, copied, report)
+            except OSError as e:
+                logger.error(f'Cannot scan {current}: {e}')
+                report['errors'] += 1
+        return True
+
+    def _check_file(self, entry, known, copy, new, copied, report):
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            # Vanished between listing and stat
+            return
+        try:
+            if known is None:
+                if copy == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    copied.append((entry.path, stat))
+                    return
+                # Added after the walk, it may turn out to be a renamed file
+                new.append((entry.path, stat))
+                return
+            file_hash, size, mtime_ns, inode, ignored = known
+            if ignored:
+                return
+            if size is None:
+                # Indexed before stats were recorded: trust the stored hash
+                with self.lock:
+                    self.dbm.update_file_stat(entry.path, stat)
+                report['adopted'] += 1
+            elif size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                with self.lock:
+                    self.dbm.update_file_hash(entry.path)
+                report['changed'] += 1
+            else:
+                report['unchanged'] += 1
+        except (OSError, ValueError) as e:
+            logger.error(f'Error while reconciling {entry.path}: {e}')
+            report['errors'] += 1
+
+    def _find_missing(self, root, index, seen):
+        prefix = root + os.sep
+        return {path for path, (_, _, _, _, ignored) in index.items()
+                if not ignored and path.startswith(prefix) and path not in seen}
+
+    def _match_renames(self, new, missing, index, report):
+        '''Record moves done while offline without rehashing, return files that are really new'''
+        by_stat = {}
+        for path in missing:
+            file_hash, size, mtime_ns, inode, _ = index[path]
+            if inode is not None:
+                by_stat[(inode, size, mtime_ns)] = path
+        if not by_stat:
+            return new
+        remaining = []
+        for path, stat in new:
+            old_path = by_stat.pop((stat.st_ino, stat.st_size, stat.st_mtime_ns), None)
+            if old_path is None:
+                remaining.append((path, stat))
+                continue
+            with self.lock:
+                self.dbm.rename_file(old_path, path, index[old_path][0])
+            missing.discard(old_path)
+            report['renamed'] += 1
+        return remaining
+
+    def _add_new(self, new, index, missing, report, deadline):
+        '''Hash and index new files, returns False when time budget runs out'''
+        # Hashes that stay indexed under another path after this scan
+        indexed = {known[0] for path, known in index.items() if path not in missing}
+        left_behind = {index[path][0]: path for path in missing}
+        for path, stat in new:
+            if time.monotonic() > deadline:
+                return False
+            try:
+                # add_file would hash it anyway, so checking for a copy is free
+                file_hash = self.dbm._calculate_file_hash(path)
+                with self.lock:
+                    if file_hash in indexed:
+                        self.dbm.update_file_stat(path, stat)
+                        report['copies'] += 1
+                        continue
+                    if file_hash in left_behind:
+                        # Content of a missing file survived here: it moved
+                        old_path = left_behind.pop(file_hash)
+                        self.dbm.rename_file(old_path, path, file_hash)
+                        self.dbm.update_file_stat(path, stat)
+                        missing.discard(old_path)
+                        report['renamed'] += 1
+                    else:
+                        self.dbm.add_file(path, file_hash=file_hash)
+                        report['new'] += 1
+                indexed.add(file_hash)
+            except (OSError, ValueError) as e:
+                logger.error(f'Error while adding {path}: {e}')
+                report['errors'] += 1
+        return True
+
+    def _remove_missing(self, missing, index, report):
+        for path in missing:
+            file_hash = index[path][0]
+            with self.lock:
+                self.dbm.remove_file_by_hash(file_hash)
+                self.dbm.remove_file(file_hash)
+            report['missing'] += 1
@@ -1,30 +1,68 @@
 # Copyright (C) 2025 Kirill Osmolovsky
-import socket, os, time, pathlib, hashlib, threading
+import socket, os, time, pathlib, hashlib, threading, struct, tempfile, zlib, shutil, random, uuid, contextlib
+from collections import OrderedDict
 from db import DatabaseManager
-from log import Logger
+from log import Logger, Progress
+from encryption import EncryptedWriter, EncryptedReader, CHUNK_SIZE, MAGIC
+from scanner import StartupScanner
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-logger = Logger().get_logger()
+logger = Logger().get_logger('server')
+
+# generation, encoding, payload length, sha256 of payload
+DB_HEADER = struct.Struct('>QBQ32s')
+# encoding flags
+DB_RAW, DB_ZLIB, DB_ENCRYPTED = 0, 1, 2
+
+# Small files are requested many at once: b'BATCH', count, then sha256 digests
+BATCH_MAGIC = b'BATCH'
+BATCH_FILE_SIZE = 64*1024
+BATCH_MAX_FILES = 512
+# status, sha256 digest, path length, file size; followed by path and body
+BATCH_ENTRY = struct.Struct('>B32sHQ')
+ENTRY_OK, ENTRY_NOT_FOUND = 0, 1
+
+# DB_UPDATED goes to at most FANOUT peers, each relays it to its part of the fleet
+FANOUT = 3
+SEEN_MESSAGES = 1024
+
+# Listen and connect from this address only, so many nodes can run on 127.0.0.x
+HOST_ENV = 'CATCHFILE_HOST'
+BIND_IP = os.environ.get(HOST_ENV)
+
+def _connect(client, address):
+    if BIND_IP:
+        client.bind((BIND_IP, 0))
+    client.connect(address)
+
+def _listen(port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((BIND_IP or '0.0.0.0', port))
+    server.listen(10)
+    return server
 
 class Server:
     def __init__(self):
         self.dbm = DatabaseManager()
         self.myip = DownloadDaemon().get_local_ip()
         self.root_dir = 'synced' # КОСТЫЛЬ!!! TODO: find out root_dir
+        self.compress_db = True
+        self.snapshots = {} # encoding -> (generation, path, length, digest)
+        self.seen_messages = OrderedDict()
+        self.update_lock = threading.Lock()
         
 
     def start_file_server(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind(('0.0.0.0', 65432))
-        server.listen(10)
+        server = _listen(65432)
         logger.info('File server started...')
 
         while True:
             try:
                 conn, addr = server.accept()
                 conn.settimeout(10)
-                logger.info(f'Connected by {addr}')
+                logger.debug('Connected by %s', addr)
 
                 if addr[0] not in self.dbm.get_known_ips():
                     logger.info(f'Unauthorized request from {addr[0]}, rejecting...')
@@ -40,26 +78,47 @@ class Server:
                 server.close()
                 time.sleep(5)
                 return self.start_file_server()  
+            reader = None
             try:
-                file_hash = conn.recv(64).decode().strip()
+                reader = conn.makefile('rb')
+                head = reader.read(len(BATCH_MAGIC))
+                if head == BATCH_MAGIC:
+                    self.send_batch(conn, reader)
+                    continue
+                hex_hash = (head + reader.read(64 - len(head))).decode().strip() if head else ''
+                try:
+                    file_hash = bytes.fromhex(hex_hash)
+                except ValueError:
+                    file_hash = None
                 if not file_hash:
-                    logger.info(f'Empty message from {addr}')
+                    logger.info(f'Empty or malformed message from {addr}')
                     conn.send(b'INVALID_REQUEST')
                     conn.close()
                     continue
                 file_path = self.dbm.get_file_path_by_hash(file_hash)
-                relative_path = pathlib.Path(file_path).relative_to(pathlib.Path(self.root_dir).resolve()).as_posix().encode()
 
                 if file_path and os.path.exists(file_path):
-                    conn.send(len(relative_path).to_bytes(4, 'big'))
-                    conn.send(relative_path)
-                    logger.info(f'Sending file {file_path}')
+                    relative_path = pathlib.Path(file_path).relative_to(pathlib.Path(self.root_dir).resolve()).as_posix().encode()
+                    framing = len(relative_path).to_bytes(4, 'big') + relative_path
+                    logger.debug('Sending file %s', file_path)
+                    key = self.dbm.get_transfer_key()
                     with open(file_path, 'rb') as f:
-                        conn.sendfile(f)
-                    logger.info('File sent')
+                        if key:
+                            # Path goes inside the stream: not leaked and authenticated
+                            writer = EncryptedWriter(conn.sendall, key)
+                            try:
+                                writer.write(framing)
+                                shutil.copyfileobj(f, writer, CHUNK_SIZE)
+                                writer.close()
+                            finally:
+                                writer.abort()
+                        else:
+                            conn.sendall(framing)
+                            conn.sendfile(f)
+                    logger.debug('File sent')
                     conn.close()
                 else:
-                    logger.info(f'File {file_hash} not found!')
+                    logger.info(f'File {hex_hash} not found!')
                     conn.send(b'NOT_FOUND')
 
             except socket.timeout:
@@ -67,13 +126,62 @@ class Server:
             except Exception as e:
                 logger.error(f'Error handling request from {addr}: {e}')
             finally:
+                # Socket isn't really closed while its file objects are open
+                if reader:
+                    reader.close()
                 conn.close()
 
+    def send_batch(self, conn, reader):
+        '''Stream requested files as one framed archive, in on-disk order'''
+        count = int.from_bytes(reader.read(4), 'big')
+        if not 0 < count <= BATCH_MAX_FILES:
+            conn.send(b'INVALID_REQUEST')
+            return
+        hashes = [reader.read(32) for _ in range(count)]
+        paths = self.dbm.get_file_paths_by_hashes(hashes)
+        root = pathlib.Path(self.root_dir).resolve()
+
+        entries, missing = [], []
+        for file_hash in hashes:
+            try:
+                stat = os.stat(paths[file_hash])
+                relative_path = pathlib.Path(paths[file_hash]).relative_to(root).as_posix().encode()
+                entries.append((stat.st_ino, file_hash, paths[file_hash], relative_path, stat.st_size))
+            except (KeyError, OSError, ValueError):
+                missing.append(file_hash)
+        # Inode order is the cheapest portable approximation of on-disk order
+        entries.sort()
+
+        key = self.dbm.get_transfer_key()
+        writer = EncryptedWriter(conn.sendall, key) if key else conn.makefile('wb', buffering=CHUNK_SIZE)
+        try:
+            for file_hash in missing:
+                writer.write(BATCH_ENTRY.pack(ENTRY_NOT_FOUND, file_hash, 0, 0))
+            for _, file_hash, file_path, relative_path, size in entries:
+                writer.write(BATCH_ENTRY.pack(ENTRY_OK, file_hash, len(relative_path), size))
+                writer.write(relative_path)
+                with open(file_path, 'rb') as f:
+                    # Send exactly the announced size even if the file grows meanwhile
+                    remaining = size
+                    while remaining:
+                        chunk = f.read(min(remaining, CHUNK_SIZE))
+                        if not chunk:
+                            raise IOError(f'{file_path} shrank while sending')
+                        writer.write(chunk)
+                        remaining -= len(chunk)
+            writer.close()
+        finally:
+            if isinstance(writer, EncryptedWriter):
+                writer.abort()
+            elif not writer.closed:
+                # Partial entry is flushed, peer reports a truncated batch
+                with contextlib.suppress(OSError):
+                    writer.close()
+        logger.info('Sent batch', extra={'fields': {'files': len(entries), 'not_found': len(missing)}})
+
     def start_db_server(self):
         '''Open server to share shared.db'''
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind(('0.0.0.0', 65431))
-        server.listen(10)
+        server = _listen(65431)
         logger.info('Waiting for incoming connection...')
         while True:
             try:
@@ -81,6 +189,7 @@ class Server:
                 conn.settimeout(10)
                 if addr[0] == self.myip:
                     logger.info(f'Recieved signal from self, ignoring...')
+                    conn.close()
                     continue
                 logger.info(f'Connected by {addr}')
                 self.dbm.add_device(str(addr[0])) 
@@ -94,12 +203,30 @@ class Server:
                     logger.info(f'Empty message from {addr}')
                     continue
 
-                if message == 'DB_UPDATED':
-                    logger.info(f'Received DB_UPDATED notification from {addr}, downloading new database...')
-                    self.download_shared_db(addr[0])
+                if message.startswith('DB_UPDATED'):
+                    msg_id, subtree, source = self._read_notification(conn, message)
+                    if msg_id in self.seen_messages:
+                        logger.debug('Notification %s already handled', msg_id)
+                        continue
+                    if msg_id:
+                        self.seen_messages[msg_id] = True
+                        if len(self.seen_messages) > SEEN_MESSAGES:
+                            self.seen_messages.popitem(last=False)
+                    conn.close()
+                    # Sender passes on a source when it couldn't get the update itself
+                    source = source or addr[0]
+                    logger.info(f'Received DB_UPDATED notification from {addr}, downloading new database from {source}...')
+                    # Keep accepting: heads we relay to connect back here for shared.db
+                    threading.Thread(target=self.handle_notification, args=(msg_id, subtree, source),
+                                     daemon=True).start()
                 else:
-                    logger.info(f'Sending shared.db to {addr}...')
-                    with open('shared.db', 'rb') as f:
+                    encoding = DB_ZLIB if message.endswith('zlib') else DB_RAW
+                    if self.dbm.get_transfer_key():
+                        encoding |= DB_ENCRYPTED
+                    generation, path, length, digest = self.get_db_snapshot(encoding)
+                    logger.info(f'Sending shared.db generation {generation} to {addr}...')
+                    conn.sendall(DB_HEADER.pack(generation, encoding, length, digest))
+                    with open(path, 'rb') as f:
                         conn.sendfile(f)
                     logger.info('Database sent successfully!')
             except socket.timeout:
@@ -109,40 +236,162 @@ class Server:
             finally:
                 conn.close()
 
+    def handle_notification(self, msg_id, subtree, source):
+        '''Download the update, then pass it on to the part of the fleet below us'''
+        # One update at a time, shared.db is replaced and files are written
+        with self.update_lock:
+            if self.download_shared_db(source):
+                # Only now we have the files and can serve the subtree ourselves
+                source = None
+        if subtree:
+            DownloadDaemon().relay_notification(msg_id, subtree, source=source)
+
+    def _read_notification(self, conn, message):
+        '''Parse "DB_UPDATED <id> <ip,ip,...|-> [source ip]", sender closes its side after the message'''
+        data = message.encode()
+        while len(data) < 65536 and (chunk := conn.recv(4096)):
+            data += chunk
+        parts = data.decode().split()
+        msg_id = parts[1] if len(parts) > 1 else None
+        subtree = parts[2].split(',') if len(parts) > 2 and parts[2] != '-' else []
+        source = parts[3] if len(parts) > 3 else None
+        return msg_id, subtree, source
+
+    def get_db_snapshot(self, encoding=DB_RAW):
+        '''Immutable copy of shared.db, rebuilt only after the database was written.
+            Length and digest describe the payload before encryption
+        '''
+        cached = self.snapshots.get(encoding)
+        if cached and cached[0] == DatabaseManager.shared_generation and os.path.exists(cached[1]):
+            return cached
+
+        raw_path = self.dbm.shared_db + '.snapshot'
+        raw = self.snapshots.get(DB_RAW)
+        if not raw or raw[0] != DatabaseManager.shared_generation or not os.path.exists(raw_path):
+            tmp_path = raw_path + '.tmp'
+            generation = self.dbm.snapshot_shared_db(tmp_path)
+            os.replace(tmp_path, raw_path)
+            raw = (generation, raw_path) + self._digest_file(raw_path)
+            self.snapshots = {DB_RAW: raw}
+            logger.info(f'Created shared.db snapshot, generation {generation}')
+        if encoding == DB_RAW:
+            return raw
+
+        generation, payload_path, length, digest = raw
+        if encoding & DB_ZLIB:
+            payload_path = f'{raw_path}.{DB_ZLIB}'
+            compressor = zlib.compressobj(6)
+            with open(raw_path, 'rb') as src, open(payload_path + '.tmp', 'wb') as dst:
+                while chunk := src.read(1024*1024):
+                    dst.write(compressor.compress(chunk))
+                dst.write(compressor.flush())
+            os.replace(payload_path + '.tmp', payload_path)
+            length, digest = self._digest_file(payload_path)
+        path = payload_path
+        if encoding & DB_ENCRYPTED:
+            # Encrypted once per generation, every peer gets the same file via sendfile
+            path = f'{raw_path}.{encoding}'
+            with open(payload_path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+                writer = EncryptedWriter(dst.write, self.dbm.get_transfer_key())
+                try:
+                    shutil.copyfileobj(src, writer, CHUNK_SIZE)
+                    writer.close()
+                finally:
+                    writer.abort()
+            os.replace(path + '.tmp', path)
+        self.snapshots[encoding] = (generation, path, length, digest)
+        return self.snapshots[encoding]
+
+    def _digest_file(self, path):
+        hasher = hashlib.sha256()
+        length = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024*1024):
+                hasher.update(chunk)
+                length += len(chunk)
+        return length, hasher.digest()
+
     def download_shared_db(self, host):
-        '''Download shared.db'''
+        '''Download shared.db into a temp file, validate it and swap it in.
+            Returns True when the database and missing files were received
+        '''
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.settimeout(10)
+        tmp_path = None
+        source = None
         try:
-            client.connect((host, 65431))
-            client.send(b'DB_NOT_UPDATED')
+            _connect(client, (host, 65431))
+            client.send(b'DB_NOT_UPDATED zlib' if self.compress_db else b'DB_NOT_UPDATED')
+            reader = client.makefile('rb')
 
-            with open('shared.db', 'wb') as f:
-                while chunk := client.recv(4096):
-                    f.write(chunk)
+            header = reader.read(DB_HEADER.size)
+            if len(header) < DB_HEADER.size:
+                raise ConnectionError('Truncated shared database header')
+            generation, encoding, length, digest = DB_HEADER.unpack(header)
+            key = self.dbm.get_transfer_key()
+            if bool(key) != bool(encoding & DB_ENCRYPTED):
+                raise ValueError(f'Encryption mismatch with {host}, are devices paired with the same link?')
+            source = EncryptedReader(reader, key) if key else reader
+
+            db_dir = os.path.dirname(os.path.abspath(self.dbm.shared_db))
+            fd, tmp_path = tempfile.mkstemp(prefix='shared.db.', suffix='.part', dir=db_dir)
+            hasher = hashlib.sha256()
+            decompressor = zlib.decompressobj() if encoding & DB_ZLIB else None
+            received = 0
+            with os.fdopen(fd, 'wb') as f:
+                while received < length:
+                    chunk = source.read(min(CHUNK_SIZE, length - received))
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    hasher.update(chunk)
+                    f.write(decompressor.decompress(chunk) if decompressor else chunk)
+                if decompressor:
+                    f.write(decompressor.flush())
 
-            logger.info('Shared database downloaded! Recieving missing files...')
-            DownloadDaemon().download_missing_files()
+            if received != length or hasher.digest() != digest:
+                raise ValueError(f'Shared database from {host} is incomplete or corrupted')
+            if not self.dbm.replace_shared_db(tmp_path):
+                raise ValueError(f'Shared database from {host} failed validation')
+            tmp_path = None
+
+            logger.info(f'Shared database generation {generation} downloaded! Recieving missing files...')
+            DownloadDaemon().apply_renames()
+            DownloadDaemon().download_missing_files(preferred=host)
             DownloadDaemon().delete_marked_files()
+            return True
         except socket.timeout:
             logger.info(f'Connection to {host} timed out!')
+            return False
         except Exception as e:
             logger.error(f'Error downloading shared database: {e}')
+            return False
         finally:
+            if isinstance(source, EncryptedReader):
+                source.close()
             client.close()
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
 class DownloadDaemon:
+    # One lock for every instance: server threads apply peer changes on fresh
+    # DownloadDaemon objects, the watchdog handler must not see them half done
+    db_lock = threading.Lock()
+    # Paths downloads are writing right now
+    incoming = set()
+
     def __init__(self):
         self.dbm = DatabaseManager()
         self.myip = self.get_local_ip()
-        logger.info(f'MY IP IS {self.myip}')
+        logger.debug('MY IP IS %s', self.myip)
         #self.s = Server()
         self.dbm.add_device(self.myip)
-        self.db_lock = threading.Lock()
         self.observer = Observer()
         self.root_dir = 'synced' # КОСТЫЛЬ!!!
 
     def get_local_ip(self):
+        if BIND_IP:
+            return BIND_IP
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(('8.8.8.8', 80))
         local_ip = s.getsockname()[0]
@@ -150,92 +399,311 @@ class DownloadDaemon:
         return local_ip
 
     def download_file_from_peer(self, host, file_hash):
+        '''Download one file, returns None when the peer can't be reached'''
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.settimeout(10)
+        source = None
         try:
-            client.connect((host, 65432))
-            client.send(file_hash.encode())
-            response = client.recv(12)
+            try:
+                _connect(client, (host, 65432))
+            except OSError as e:
+                logger.error(f'Cannot connect to {host}: {e}')
+                return None
+            client.send(file_hash.hex().encode())
+            reader = client.makefile('rb')
+            response = reader.read(4)
 
-            if response in [b'UNAUTHORIZED', b'NOT_FOUND', b'INVALID_REQUEST']:
-                logger.error(f'Server response: {response.decode()}')
+            key = self.dbm.get_transfer_key()
+            source = reader
+            if response == MAGIC:
+                if not key:
+                    raise ValueError(f'{host} sent an encrypted file, are devices paired with the same link?')
+                source = EncryptedReader(reader, key, header=response)
+                response = source.read(4)
+            # Path length never reaches 2**24, so error replies are told apart by first byte
+            elif not response or response[0] != 0:
+                response += reader.read(64)
+                logger.error(f'Server response: {response.decode(errors="replace")}')
                 return False
-        
-            length = int.from_bytes(response[:4], 'big')
-            relative_path = client.recv(length).decode().strip()
-
-            file_path = pathlib.Path(self.root_dir).resolve() / pathlib.Path(relative_path)
-            file_path = file_path.resolve()
-            os.makedirs(file_path.parent, exist_ok=True)
+            elif key:
+                raise ValueError(f'{host} sent an unencrypted file, are devices paired with the same link?')
 
-            with open(file_path, 'wb') as f:
-                while chunk := client.recv(4096):
-                    f.write(chunk)
-            self.dbm.add_file(str(file_path))
+            length = int.from_bytes(response, 'big')
+            file_path = self._local_path(source.read(length).decode().strip())
+            with self._receiving(file_path):
+                self._receive_file(source, file_path, file_hash)
+                self.dbm.add_file(str(file_path), file_hash=file_hash)
             return True
         except socket.timeout:
             logger.error(f'Connection to {host} timed out!')
             return False
         except Exception as e:
-            logger.error(f'Failed to download {file_hash} from {host}: {e}')
+            logger.error(f'Failed to download {file_hash.hex()} from {host}: {e}')
             return False
         finally:
+            if isinstance(source, EncryptedReader):
+                source.close()
             client.close() 
     
-    def download_missing_files(self):
+    @contextlib.contextmanager
+    def _receiving(self, file_path):
+        '''Mark path as written by a download until it is indexed,
+            watchdog events for it are not local changes
+        '''
+        self.incoming.add(str(file_path))
+        try:
+            yield
+        finally:
+            self.incoming.discard(str(file_path))
+
+    def _receive_file(self, source, file_path, file_hash, size=None):
+        '''Write size bytes (or the rest of the stream) into a temp file next to
+            file_path, verify while writing and move it in place only when the
+            hash matches. Whatever is at file_path stays untouched until then
+        '''
+        # Marked before it exists: watchdog must never see the partial file as new
+        tmp_path = str(file_path.parent / f'.{file_path.name}.{uuid.uuid4().hex[:8]}.part')
+        self.incoming.add(tmp_path)
+        replaced = False
+        try:
+            hasher = hashlib.sha256()
+            with open(tmp_path, 'xb') as f:
+                remaining = size
+                while remaining is None or remaining:
+                    chunk = source.read(CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        if remaining:
+                            raise ConnectionError('Stream is truncated')
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+            if hasher.digest() != file_hash:
+                raise ValueError(f'Hash mismatch for {file_path}, discarding')
+            os.replace(tmp_path, file_path)
+            replaced = True
+        finally:
+            if not replaced and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.incoming.discard(tmp_path)
+
+    def _local_path(self, relative_path):
+        '''Resolve path sent by peer inside root_dir and create its parent'''
+        root = pathlib.Path(self.root_dir).resolve()
+        file_path = (root / pathlib.Path(relative_path)).resolve()
+        if not file_path.is_relative_to(root):
+            raise ValueError(f'Peer sent path outside of synced directory: {relative_path}')
+        os.makedirs(file_path.parent, exist_ok=True)
+        return file_path
+
+    def download_batch_from_peer(self, host, hashes):
+        '''Request many small files in one connection, return set of received hashes.
+            None means the peer is unreachable or the stream broke, files received
+            before that are indexed anyway
+        '''
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(10)
+        received = set()
+        requested = set(hashes)
+        source = None
+        try:
+            _connect(client, (host, 65432))
+            client.sendall(BATCH_MAGIC + len(hashes).to_bytes(4, 'big') + b''.join(hashes))
+            reader = client.makefile('rb')
+            key = self.dbm.get_transfer_key()
+            if key:
+                source = EncryptedReader(reader, key)
+            else:
+                source = reader
+                if reader.peek(1)[:1] not in (bytes([ENTRY_OK]), bytes([ENTRY_NOT_FOUND])):
+                    logger.error(f'Server response: {reader.read(64).decode(errors="replace")}')
+                    return None
+
+            for _ in range(len(hashes)):
+                header = source.read(BATCH_ENTRY.size)
+                if len(header) < BATCH_ENTRY.size:
+                    raise ConnectionError('Batch stream is truncated')
+                status, digest, path_length, size = BATCH_ENTRY.unpack(header)
+                if status != ENTRY_OK:
+                    continue
+                if digest not in requested:
+                    # Matching its own digest proves nothing, peer could write anything anywhere
+                    raise ValueError(f'{host} sent a file that was not requested')
+                requested.discard(digest)
+                file_path = self._local_path(source.read(path_length).decode())
+                with self._receiving(file_path):
+                    try:
+                        self._receive_file(source, file_path, digest, size)
+                    except ValueError as e:
+                        # Body was read completely, the rest of the batch is still usable
+                        logger.error(f'{e} (from {host})')
+                        continue
+                    self.dbm.add_file(str(file_path), file_hash=digest)
+                received.add(digest)
+        except socket.timeout:
+            logger.error(f'Connection to {host} timed out!')
+            return None
+        except Exception as e:
+            logger.error(f'Failed to download batch of {len(hashes)} files from {host}: {e}')
+            return None
+        finally:
+            if isinstance(source, EncryptedReader):
+                source.close()
+            client.close()
+        return received
+
+    def download_missing_files(self, preferred=None):
+        '''Download files from preferred peer first (the one that notified us
+            and already has them), then from the others in random order
+        '''
         missing_files = self.dbm.get_missing_files()
         if not missing_files:
             logger.info('No missing files found')
             return
-        shared_ips = self.dbm.get_known_ips()
+        shared_ips = [ip for ip in self.dbm.get_known_ips() if ip != self.myip]
+        random.shuffle(shared_ips)
+        if preferred in shared_ips:
+            shared_ips.remove(preferred)
+            shared_ips.insert(0, preferred)
+
+        progress = Progress(logger, 'Downloading missing files')
+        sizes = self.dbm.get_file_sizes(missing_files)
+        pending = [h for h in missing_files if sizes.get(h, BATCH_FILE_SIZE + 1) <= BATCH_FILE_SIZE]
+        batched = set(pending)
+        # Peers that failed once are skipped, every retry of a dead peer costs a timeout
+        unreachable = set()
+        for ip in shared_ips:
+            if not pending:
+                break
+            received = set()
+            for i in range(0, len(pending), BATCH_MAX_FILES):
+                part = pending[i:i + BATCH_MAX_FILES]
+                batch = self.download_batch_from_peer(ip, part)
+                if batch is None:
+                    unreachable.add(ip)
+                    received |= self.dbm.get_file_paths_by_hashes(part).keys()
+                    break
+                received |= batch
+            for file_hash in received:
+                progress.add('downloaded', file_hash)
+            pending = [h for h in pending if h not in received]
+        for file_hash in pending:
+            progress.add('not_found', file_hash)
+        missing_files = [h for h in missing_files if h not in batched]
 
         for file_hash in missing_files:
             for ip in shared_ips:
-                logger.info(f'Requesting {file_hash} from {ip}')
-                if self.download_file_from_peer(ip, file_hash):
-                    logger.info(f'File {file_hash} downloaded!')
+                if ip in unreachable:
+                    continue
+                logger.debug('Requesting %s from %s', file_hash.hex(), ip)
+                result = self.download_file_from_peer(ip, file_hash)
+                if result is None:
+                    unreachable.add(ip)
+                elif result:
+                    progress.add('downloaded', file_hash)
                     break
             else:
-                logger.info(f'File {file_hash} not found on any device')
+                progress.add('not_found', file_hash)
+        progress.close()
+
+    def apply_renames(self):
+        '''Move local files to paths peers renamed them to, instead of downloading again'''
+        root = pathlib.Path(self.root_dir).resolve()
+        moved = 0
+        for file_hash, shared_path, local_path in self.dbm.get_shared_paths():
+            target = (root / shared_path).resolve()
+            if str(target) == local_path or not target.is_relative_to(root):
+                continue
+            # Files outside root_dir have no shared path here, never pull them in
+            if not pathlib.Path(local_path).is_relative_to(root):
+                continue
+            if target.exists() or not os.path.exists(local_path):
+                continue
+            try:
+                with self.db_lock:
+                    os.makedirs(target.parent, exist_ok=True)
+                    os.rename(local_path, target)
+                    self.dbm.rename_file(local_path, str(target), file_hash)
+                moved += 1
+                # Mirror directory moves: drop directories the move left empty
+                parent = pathlib.Path(local_path).parent
+                while parent != root and parent.is_relative_to(root) and not any(parent.iterdir()):
+                    parent.rmdir()
+                    parent = parent.parent
+            except OSError as e:
+                logger.error(f'Failed to move {local_path} to {target}: {e}')
+        if moved:
+            logger.info(f'Applied {moved} renames from shared database')
 
     def delete_marked_files(self):
-        marked_files_hashes = self.dbm.get_deleted_files()
-        marked_files_paths = [self.dbm.get_file_path_by_hash(i) for i in marked_files_hashes]
-        if not marked_files_paths:
+        # Tombstones stay in shared.db, only those with a local copy left need work
+        marked_files = self.dbm.get_file_paths_by_hashes(self.dbm.get_deleted_files() or [])
+        if not marked_files:
             logger.info('No deleted files found')
             return
-        for file in marked_files_paths:
+        for file_hash, file in marked_files.items():
             try:
-                self.dbm.remove_file_by_hash(self.dbm.get_file_hash_by_path(file)) # too sophisticated
+                self.dbm.remove_file_by_hash(file_hash)
                 os.remove(file)
             except FileNotFoundError:
                 logger.info('File already deleted')
-            except TypeError as e:
-                logger.error(f'Error {e}')
 
-    def notify_devices(self):
-        shared_ips = self.dbm.get_known_ips()
-        for ip in shared_ips:
-            if ip == self.myip:
-                continue
-            try:
-                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client.settimeout(10)
-                client.connect((ip, 65431))
-                client.send(b'DB_UPDATED')
-                client.close()
-            except Exception as e:
-                logger.error(f'Failed to notify {ip}: {e}')
+    def notify_devices(self, fanout=FANOUT):
+        '''Spread DB_UPDATED through a tree, so no device talks to the whole fleet'''
+        peers = [ip for ip in self.dbm.get_known_ips() if ip != self.myip]
+        # New tree shape every time, so the same devices don't always do the relaying
+        random.shuffle(peers)
+        self.relay_notification(uuid.uuid4().hex, peers, fanout)
+
+    def relay_notification(self, msg_id, peers, fanout=FANOUT, source=None):
+        '''Notify up to fanout peers, each gets the rest of its group to relay to.
+            Peers download from source if given, from this device otherwise
+        '''
+        peers = [ip for ip in peers if ip not in (self.myip, source)]
+        for group in (peers[i::fanout] for i in range(fanout)):
+            while group:
+                head, group = group[0], group[1:]
+                # Unreachable head: next device of the group takes its place
+                if self._send_notification(head, msg_id, group, source):
+                    break
+
+    def _send_notification(self, ip, msg_id, subtree, source=None):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(10)
+        message = f'DB_UPDATED {msg_id} {",".join(subtree) or "-"}'
+        if source:
+            message += f' {source}'
+        try:
+            _connect(client, (ip, 65431))
+            client.sendall(message.encode())
+            client.shutdown(socket.SHUT_WR)
+            logger.debug('Notified %s, relaying to %d more', ip, len(subtree))
+            return True
+        except Exception as e:
+            logger.error(f'Failed to notify {ip}: {e}')
+            return False
+        finally:
+            client.close()
             
+    def reconcile_directories(self, directories, time_budget=60.0):
+        '''Pick up changes made while the daemon was stopped'''
+        report = StartupScanner(self.dbm, self.db_lock, time_budget).scan(directories)
+        if report['new'] or report['changed'] or report['missing'] or report['renamed']:
+            self.notify_devices()
+        return report
+
     def monitoring(self):
         '''Uses watchdog to monitor file system changes dynamically.'''
+        with self.db_lock:
+            directories_to_watch = self.dbm.get_local_directories()
+
+        self.reconcile_directories(directories_to_watch)
+        self.apply_renames()
         self.download_missing_files()
         self.delete_marked_files()
         logger.info("Starting real-time file monitoring...")
 
-        with self.db_lock:
-            directories_to_watch = self.dbm.get_local_directories()
-
         event_handler = FileChangeHandler(self)
         for directory in directories_to_watch:
             path = pathlib.Path(directory).resolve()
@@ -263,12 +731,25 @@ class FileChangeHandler(FileSystemEventHandler):
         if event.is_directory:
             return
         file_path = pathlib.Path(event.src_path).resolve()
-        logger.info(f"New file detected: {file_path}")
+        dbm = self.daemon.dbm
         try:
             with self.daemon.db_lock:
-                self.daemon.dbm.add_file(str(file_path))
+                if self._is_known(str(file_path)):
+                    # Downloaded from a peer: the fleet already has it, no new gossip round
+                    logger.debug('Created file %s is already indexed', file_path)
+                    return
+            file_hash = dbm._calculate_file_hash(file_path)
+            with self.daemon.db_lock:
+                indexed_path = dbm.get_file_path_by_hash(file_hash)
+                if indexed_path and indexed_path != str(file_path) and os.path.exists(indexed_path):
+                    # Copy of indexed content: local.db keeps one path per hash, like the scanner
+                    dbm.update_file_stat(str(file_path), os.stat(file_path))
+                    logger.debug('Created file %s is a copy of %s', file_path, indexed_path)
+                    return
+                logger.info(f"New file detected: {file_path}")
+                dbm.add_file(str(file_path), file_hash=file_hash)
             self.daemon.notify_devices()
-        except ValueError:
+        except (OSError, ValueError):
             logger.error(f'Error while adding created file {file_path}, possible temporary file')
 
     def on_deleted(self, event):
@@ -282,7 +763,72 @@ class FileChangeHandler(FileSystemEventHandler):
             if file_hash:
                 self.daemon.dbm.remove_file_by_hash(file_hash)
                 self.daemon.dbm.remove_file(file_hash)
-        self.daemon.notify_devices()
+            else:
+                # Copies of indexed content only have a stat row
+                self.daemon.dbm.remove_file_stat(str(file_path))
+        # Untracked files and deletions made by delete_marked_files change nothing
+        if file_hash:
+            self.daemon.notify_devices()
+
+    def _is_known(self, file_path):
+        '''Being downloaded, or indexed with the stat it has now'''
+        if file_path in self.daemon.incoming:
+            return True
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            # Gone already, e.g. temp file of a download: nothing to index
+            return True
+        return self.daemon.dbm.get_file_stat(file_path) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def on_moved(self, event):
+        """Handles renames and moves as metadata-only changes."""
+        src_path = str(pathlib.Path(event.src_path).resolve())
+        dest_path = str(pathlib.Path(event.dest_path).resolve())
+        if dest_path in self.daemon.incoming:
+            # Download moving its verified temp file in place
+            return
+        logger.info(f"Moved: {src_path} -> {dest_path}")
+        try:
+            with self.daemon.db_lock:
+                if event.is_directory:
+                    changed = self.daemon.dbm.rename_directory(src_path, dest_path) > 0
+                else:
+                    changed = self._move_file(src_path, dest_path)
+            if changed:
+                self.daemon.notify_devices()
+        except (OSError, ValueError) as e:
+            logger.error(f'Error while moving {src_path} to {dest_path}: {e}')
+
+    def _move_file(self, src_path, dest_path):
+        dbm = self.daemon.dbm
+        file_hash = dbm.get_file_hash_by_path(src_path)
+        replaced_hash = dbm.get_file_hash_by_path(dest_path)
+        stat = os.stat(dest_path)
+        if file_hash is None:
+            if replaced_hash is None:
+                dbm.add_file(dest_path)
+            elif dbm.get_file_stat(dest_path) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                # Already moved along with its directory
+                return False
+            else:
+                # Atomic save: untracked temporary file renamed over the old version
+                dbm.update_file_hash(dest_path)
+            return True
+
+        if replaced_hash and replaced_hash != file_hash:
+            # Atomic save: tracked temporary file renamed over the old version
+            dbm.remove_file_by_hash(replaced_hash)
+            dbm.remove_file(replaced_hash)
+        known = dbm.get_file_stat(src_path)
+        if known and known != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            # Can't prove it's the same content, e.g. moved across filesystems and touched
+            dbm.remove_file_by_hash(file_hash)
+            dbm.remove_file(file_hash)
+            dbm.add_file(dest_path)
+            return True
+        dbm.rename_file(src_path, dest_path, file_hash)
+        return True
 
     def on_modified(self, event):
         """Handles file modifications (if needed)."""